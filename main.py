@@ -1,7 +1,29 @@
+import json
+import re
+from contextlib import asynccontextmanager
 from enum import Enum
-from fastapi import Body, FastAPI, Path, Query
-from pydantic import BaseModel, Field, HttpUrl
-from typing import Annotated, List
+from fastapi import (
+    APIRouter,
+    Body,
+    FastAPI,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
+from pydantic import (
+    AfterValidator,
+    BaseModel,
+    Field,
+    HttpUrl,
+    TypeAdapter,
+    ValidationError,
+)
+from typing import Annotated, Any, List
 
 
 # Nested Models
@@ -10,6 +32,22 @@ class Image(BaseModel):
     name: str
 
 
+# Trusted bulk image uploads only get a cheap http(s) URL check instead of
+# full HttpUrl parsing
+HTTP_URL_RE = re.compile(r"https?://[^\s/$.?#][^\s]*", re.IGNORECASE)
+
+
+def validate_http_url(url: str) -> str:
+    if not HTTP_URL_RE.fullmatch(url):
+        raise ValueError("URL must be an absolute http(s) URL")
+    return url
+
+
+class TrustedImage(BaseModel):
+    url: Annotated[str, AfterValidator(validate_http_url)]
+    name: str
+
+
 # Body - Fields
 # Body - Nested Models
 class Item(BaseModel):
@@ -19,7 +57,7 @@ class Item(BaseModel):
     )
     price: float = Field(gt=0, description="The price must be greater than zero")
     tax: float | None = None
-    tags: list[str] = set()
+    tags: set[str] = Field(default_factory=set)
     images: list[Image] | None = None
 
 
@@ -37,37 +75,177 @@ class ModelName(str, Enum):
     lenet = "lenet"
 
 
+MODEL_MESSAGES = {
+    ModelName.alexnet: "Deep Learning FTW!",
+    ModelName.lenet: "LeCNN all the images",
+    ModelName.resnet: "Have some residuals",
+}
+
+
 class User(BaseModel):
     username: str
     full_name: str | None = None
 
 
-app = FastAPI()
+# Parameter declarations repeated across tutorial steps. Only
+# BOUNDED_ITEM_ID_PATH is used by a route on `app`; the others are shared by
+# the previous_steps handlers.
+BOUNDED_ITEM_ID_PATH = Path(title="The ID of the item to get", ge=0, le=1000)
+ITEM_QUERY_ALIAS = Query(alias="item-query")
+MIN_LENGTH_QUERY = Query(min_length=3)
+
+FIXED_QUERY_PATTERN = "^fixedquery$"
+
+
+# Raw JSON bodies
+# A valid body is parsed and validated straight from JSON bytes by
+# pydantic-core in one pass. Only when that fails is the body decoded again,
+# so the 422/400 responses match the ones FastAPI gives for a declared body.
+images_adapter = TypeAdapter(list[Image])
+trusted_images_adapter = TypeAdapter(list[TrustedImage])
+
+VALIDATION_ERROR_RESPONSE = {
+    422: {
+        "description": "Validation Error",
+        "content": {
+            "application/json": {
+                "schema": {"$ref": "#/components/schemas/HTTPValidationError"}
+            }
+        },
+    }
+}
+
+
+def json_array_body(model: type[BaseModel]) -> dict:
+    return {
+        "requestBody": {
+            "content": {
+                "application/json": {
+                    "schema": {"type": "array", "items": model.model_json_schema()}
+                }
+            },
+            "required": True,
+        }
+    }
+
+
+def is_json_content_type(request: Request) -> bool:
+    content_type = request.headers.get("content-type", "")
+    media_type = content_type.partition(";")[0].strip().lower()
+    return media_type == "application/json" or (
+        media_type.startswith("application/") and media_type.endswith("+json")
+    )
+
+
+async def validate_json_body(request: Request, adapter: TypeAdapter):
+    body = await request.body()
+    if body and is_json_content_type(request):
+        try:
+            return adapter.validate_json(body)
+        except ValidationError:
+            pass
+        try:
+            body = json.loads(body)
+        except json.JSONDecodeError as e:
+            raise RequestValidationError(
+                [
+                    {
+                        "type": "json_invalid",
+                        "loc": ("body", e.pos),
+                        "msg": "JSON decode error",
+                        "input": {},
+                        "ctx": {"error": e.msg},
+                    }
+                ]
+            )
+        except ValueError:
+            raise HTTPException(
+                status_code=400, detail="There was an error parsing the body"
+            )
+    if body is None or body == b"":
+        raise RequestValidationError(
+            [
+                {
+                    "type": "missing",
+                    "loc": ("body",),
+                    "msg": "Field required",
+                    "input": None,
+                }
+            ]
+        )
+    # A non-JSON body stays raw bytes, so it fails validation like in FastAPI
+    try:
+        return adapter.validate_python(body)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [
+                {**error, "loc": ("body", *error["loc"])}
+                for error in e.errors(include_url=False)
+            ]
+        )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the OpenAPI schema now instead of on the first /docs request
+    app.openapi()
+    yield
+
 
-fake_items_db = [{"item_name": "Foo"}, {"item_name": "Bar"}, {"item_name": "Baz"}]
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(GZipMiddleware, minimum_size=256, compresslevel=4)
+
+# Earlier tutorial steps that declare a method + path already served by `app`.
+# Starlette only dispatches to the first matching route, so these are kept on a
+# router that is never included, instead of adding dead routes to `app`.
+previous_steps = APIRouter()
+
+# Constant responses, encoded once
+ROOT_BODY = JSONResponse({"message": "Hello World"}).body
+USER_ME_BODY = JSONResponse({"user_id": "the current user"}).body
+
+ITEM_DESCRIPTION = "This is an amazing item that has a long description"
+
+fake_item_names = ("Foo", "Bar", "Baz")
 
 
 # Bodies of arbitrary dict
 @app.post("/index-weights/")
-async def create_index_weights(weights: dict[int, float]):
+async def create_index_weights(weights: dict[int, float]) -> dict[int, float]:
     return weights
 
 
 # Bodies of pure lists
-@app.post("/images/multiple/")
-async def create_multiple_images(images: list[Image]):
-    return images
+@app.post(
+    "/images/multiple/",
+    openapi_extra=json_array_body(Image),
+    responses=VALIDATION_ERROR_RESPONSE,
+)
+async def create_multiple_images(request: Request) -> list[Image]:
+    return await validate_json_body(request, images_adapter)
+
+
+# Bulk ingest from trusted sources, with the cheaper URL check
+@app.post(
+    "/images/multiple/trusted/",
+    openapi_extra=json_array_body(TrustedImage),
+    responses=VALIDATION_ERROR_RESPONSE,
+)
+async def create_multiple_trusted_images(request: Request) -> list[TrustedImage]:
+    return await validate_json_body(request, trusted_images_adapter)
 
 
 # Embed a single body parameter
 @app.put("/items/{item_id}")
-async def update_item(item_id: int, item: Annotated[Item, Body(embed=True)]):
+async def update_item(
+        item_id: int, item: Annotated[Item, Body(embed=True)]
+) -> dict[str, int | Item]:
     results = {"item_id": item_id, "item": item}
     return results
 
 
 # Multiple body params and query
-@app.put("/items/{item_id}")
+@previous_steps.put("/items/{item_id}")
 async def update_item(
         *,
         item_id: int,
@@ -78,12 +256,12 @@ async def update_item(
 ):
     results = {"item_id": item_id, "item": item, "user": user, "importance": importance}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Singular values in body
-@app.put("/items/{item_id}")
+@previous_steps.put("/items/{item_id}")
 async def update_item(
         item_id: int, item: Item, user: User, importance: Annotated[int, Body()]
 ):
@@ -93,17 +271,17 @@ async def update_item(
 
 # Body - Multiple Parameters
 # Mix Path, Query and body parameters
-@app.put("/items/{item_id}")
+@previous_steps.put("/items/{item_id}")
 async def update_item(
-        item_id: Annotated[int, Path(title="The ID of the item to get", ge=0, le=1000)],
+        item_id: Annotated[int, BOUNDED_ITEM_ID_PATH],
         q: str | None = None,
         item: Item | None = None,
 ):
     results = {"item_id": item_id}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     if item:
-        results.update({"item": item})
+        results["item"] = item
     return results
 
 
@@ -111,57 +289,57 @@ async def update_item(
 @app.get("/items/{item_id}")
 async def read_items(
         *,
-        item_id: Annotated[int, Path(title="The ID of the item to get", ge=0, le=1000)],
+        item_id: Annotated[int, BOUNDED_ITEM_ID_PATH],
         q: str,
         size: Annotated[float, Query(gt=0, lt=10.5)],
-):
+) -> dict[str, int | str]:
     results = {"item_id": item_id}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Number validations: greater than and less than or equal
-@app.get("/items/{item_id}")
+@previous_steps.get("/items/{item_id}")
 async def read_items(
         item_id: Annotated[int, Path(title="The ID of the item to get", gt=0, le=1000)],
         q: str,
 ):
     results = {"item_id": item_id}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Number validations: greater than or equal
-@app.get("/items/{item_id}")
+@previous_steps.get("/items/{item_id}")
 async def read_items(
         item_id: Annotated[int, Path(title="The ID of the item to get", ge=1)], q: str
 ):
     results = {"item_id": item_id}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Order the parameters as you need, tricks
-@app.get("/items/{item_id}")
+@previous_steps.get("/items/{item_id}")
 async def read_items(*, item_id: int = Path(title="The ID of the item to get"), q: str):
     results = {"item_id": item_id}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Path Parameters and Numeric Validations
-@app.get("/items/{item_id}")
+@previous_steps.get("/items/{item_id}")
 async def read_items(
         item_id: Annotated[int, Path(title="The ID of the item to get")],
-        q: Annotated[str | None, Query(alias="item-query")] = None,
+        q: Annotated[str | None, ITEM_QUERY_ALIAS] = None,
 ):
     results = {"item_id": item_id}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
@@ -169,7 +347,7 @@ async def read_items(
 @app.get("/items/")
 async def read_items(
         hidden_query: Annotated[str | None, Query(include_in_schema=False)] = None,
-):
+) -> dict[str, str]:
     if hidden_query:
         return {"hidden_query": hidden_query}
     else:
@@ -177,7 +355,7 @@ async def read_items(
 
 
 # Deprecating parameters
-@app.get("/items/")
+@previous_steps.get("/items/")
 async def read_items(
         q: Annotated[
             str | None,
@@ -187,30 +365,30 @@ async def read_items(
                 description="Query string for the items to search in the database that have a good match",
                 min_length=3,
                 max_length=50,
-                pattern="^fixedquery$",
+                pattern=FIXED_QUERY_PATTERN,
                 deprecated=True,
             ),
         ] = None,
 ):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Alias parameters
 # try:
 #   http://127.0.0.1:8000/items/?item-query=foobaritems
-@app.get("/items/")
-async def read_items(q: Annotated[str | None, Query(alias="item-query")] = None):
+@previous_steps.get("/items/")
+async def read_items(q: Annotated[str | None, ITEM_QUERY_ALIAS] = None):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Declare more metadata
-@app.get("/items/")
+@previous_steps.get("/items/")
 async def read_items(
         q: Annotated[
             str | None,
@@ -223,14 +401,14 @@ async def read_items(
 ):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Query parameter list / multiple values with defaults
 # try:
 #   http://localhost:8000/items/
-@app.get("/items/")
+@previous_steps.get("/items/")
 async def read_items(q: Annotated[List[str], Query()] = ["foo", "bar"]):
     query_items = {"q": q}
     return query_items
@@ -239,123 +417,123 @@ async def read_items(q: Annotated[List[str], Query()] = ["foo", "bar"]):
 # Query parameter list / multiple values
 # try:
 #   http://localhost:8000/items/?q=foo&q=bar
-@app.get("/items/")
+@previous_steps.get("/items/")
 async def read_items(q: Annotated[list[str] | None, Query()] = None):
     query_items = {"q": q}
     return query_items
 
 
 # Required with None
-@app.get("/items/")
-async def read_items(q: Annotated[str | None, Query(min_length=3)] = ...):
+@previous_steps.get("/items/")
+async def read_items(q: Annotated[str | None, MIN_LENGTH_QUERY] = ...):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Required with Ellipsis (...)
-@app.get("/items/")
-async def read_items(q: Annotated[str, Query(min_length=3)] = ...):
+@previous_steps.get("/items/")
+async def read_items(q: Annotated[str, MIN_LENGTH_QUERY] = ...):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Make it required
-@app.get("/items/")
-async def read_items(q: Annotated[str, Query(min_length=3)]):
+@previous_steps.get("/items/")
+async def read_items(q: Annotated[str, MIN_LENGTH_QUERY]):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Default values
-@app.get("/items/")
-async def read_items(q: Annotated[str, Query(min_length=3)] = "fixedquery"):
+@previous_steps.get("/items/")
+async def read_items(q: Annotated[str, MIN_LENGTH_QUERY] = "fixedquery"):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Add regular expressions
-@app.get("/items/")
+@previous_steps.get("/items/")
 async def read_items(
         q: Annotated[
-            str | None, Query(min_length=3, max_length=50, pattern="^fixedquery$")
+            str | None, Query(min_length=3, max_length=50, pattern=FIXED_QUERY_PATTERN)
         ] = None,
 ):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Add more validations
-@app.get("/items/")
+@previous_steps.get("/items/")
 async def read_items(
         q: Annotated[str | None, Query(min_length=3, max_length=50)] = None,
 ):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Alternative (old) Query as the default value
-@app.get("/items/")
+@previous_steps.get("/items/")
 async def read_items(q: str | None = Query(default=None, max_length=50)):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Query Parameters and String Validations
-@app.get("/items/")
+@previous_steps.get("/items/")
 async def read_items(q: Annotated[str | None, Query(max_length=50)] = None):
     results = {"items": [{"item_id": "Foo"}, {"item_id": "Bar"}]}
     if q:
-        results.update({"q": q})
+        results["q"] = q
     return results
 
 
 # Request body + path + query parameters
-@app.put("/items/{item_id}")
+@previous_steps.put("/items/{item_id}")
 async def update_item(item_id: int, item: Item, q: str | None = None):
     result = {"item_id": item_id, **item.model_dump()}
     if q:
-        result.update({"q": q})
+        result["q"] = q
     return result
 
 
 # Request body + path parameters
-@app.put("/items/{item_id}")
+@previous_steps.put("/items/{item_id}")
 async def update_item(item_id: int, item: Item):
     return {"item_id": item_id, **item.model_dump()}
 
 
 # Use the model
 @app.post("/items/")
-async def create_item(item: Item):
+async def create_item(item: Item) -> dict[str, Any]:
     item_dict = item.model_dump()
     if item.tax:
         price_with_tax = item.price + item.tax
-        item_dict.update({"price_with_tax": price_with_tax})
+        item_dict["price_with_tax"] = price_with_tax
     return item_dict
 
 
 # Request Body
-@app.post("/items/")
+@previous_steps.post("/items/")
 async def create_item(item: Item):
     return item
 
 
 # Required parameters + Optional parameters
-@app.get("/items/{item_id}")
+@previous_steps.get("/items/{item_id}")
 async def read_user_item(
         item_id: str, needy: str, skip: int = 0, limit: int | None = None
 ):
@@ -367,7 +545,7 @@ async def read_user_item(
 # try:
 #   http://127.0.0.1:8000/items/foo-item
 #   http://127.0.0.1:8000/items/foo-item?needy=sooooneedy
-@app.get("/items/{item_id}")
+@previous_steps.get("/items/{item_id}")
 async def read_user_item(item_id: str, needy: str):
     item = {"item_id": item_id, "needy": needy}
     return item
@@ -377,14 +555,12 @@ async def read_user_item(item_id: str, needy: str):
 @app.get("/users/{user_id}/items/{item_id}")
 async def read_user_item(
         user_id: int, item_id: str, q: str | None = None, short: bool = False
-):
+) -> dict[str, int | str]:
     item = {"item_id": item_id, "owner_id": user_id}
     if q:
-        item.update({"q": q})
+        item["q"] = q
     if not short:
-        item.update(
-            {"description": "This is an amazing item that has a long description"}
-        )
+        item["description"] = ITEM_DESCRIPTION
     return item
 
 
@@ -395,20 +571,18 @@ async def read_user_item(
 #   http://127.0.0.1:8000/items/foo?short=true
 #   http://127.0.0.1:8000/items/foo?short=on
 #   http://127.0.0.1:8000/items/foo?short=yes
-@app.get("/items/{item_id}")
+@previous_steps.get("/items/{item_id}")
 async def read_item(item_id: str, q: str | None = None, short: bool = False):
     item = {"item_id": item_id}
     if q:
-        item.update({"q": q})
+        item["q"] = q
     if not short:
-        item.update(
-            {"description": "This is an amazing item that has a long description"}
-        )
+        item["description"] = ITEM_DESCRIPTION
     return item
 
 
 # Optional parameters
-@app.get("/items/{item_id}")
+@previous_steps.get("/items/{item_id}")
 async def read_item(item_id: str, q: str | None = None):
     if q:
         return {"item_id": item_id, "q": q}
@@ -420,53 +594,55 @@ async def read_item(item_id: str, q: str | None = None):
 #   http://127.0.0.1:8000/items/
 #   http://127.0.0.1:8000/items/?skip=0&limit=10
 #   http://127.0.0.1:8000/items/?skip=20
-@app.get("/items/")
+@previous_steps.get("/items/")
 async def read_item(skip: int = 0, limit: int = 10):
-    return fake_items_db[skip: skip + limit]
+    return [{"item_name": name} for name in fake_item_names[skip: skip + limit]]
 
 
 # Path parameters containing paths
 @app.get("/files/{file_path:path}")
-async def read_file(file_path: str):
+async def read_file(file_path: str) -> dict[str, str]:
     return {"file_path": file_path}
 
 
 # Predefined values
 @app.get("/models/{model_name}")
-async def get_model(model_name: ModelName):
-    if model_name is ModelName.alexnet:
-        return {"model_name": model_name, "message": "Deep Learning FTW!"}
-
-    if model_name.value == "lenet":
-        return {"model_name": model_name, "message": "LeCNN all the images"}
-
-    return {"model_name": model_name, "message": "Have some residuals"}
+async def get_model(model_name: ModelName) -> dict[str, str]:
+    return {"model_name": model_name, "message": MODEL_MESSAGES[model_name]}
 
 
 # Order matters 1
 @app.get("/users/me")
 async def read_user_me():
-    return {"user_id": "the current user"}
+    return Response(content=USER_ME_BODY, media_type="application/json")
 
 
 # Order matters 2
 @app.get("/users/{user_id}")
-async def read_user(user_id: str):
+async def read_user(user_id: str) -> dict[str, str]:
     return {"user_id": user_id}
 
 
 # Path Parameters with types
-@app.get("/items/{item_id}")
+@previous_steps.get("/items/{item_id}")
 async def read_item(item_id: int):
     return {"item_id": item_id}
 
 
 # Path Parameters
-@app.get("/items/{item_id}")
+@previous_steps.get("/items/{item_id}")
 async def read_item(item_id):
     return {"item_id": item_id}
 
 
 @app.get("/")
 async def root():
-    return {"message": "Hello World"}
+    return Response(content=ROOT_BODY, media_type="application/json")
+
+
+# Run with uvloop + httptools (pip install "uvicorn[standard]"):
+#   python main.py
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, loop="uvloop", http="httptools")